@@ -1,44 +1,57 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
+import concurrent.futures
+import functools
 import os
 import re
 import subprocess
 import sys
+import tempfile
 
 from pathlib import Path
 
+_CYAN = "\033[36m"
+_RED = "\033[31m"
+_BOLD = "\033[1m"
+_END = "\033[0m"
 
-class COLORS:
-    CYAN = "\033[36m"
-    GREEN = "\033[32m"
-    RED = "\033[31m"
-    BOLD = "\033[1m"
-    END = "\033[0m"
 
-    def cyan(s):
-        return COLORS.CYAN + str(s) + COLORS.END
+def cyan(s):
+    return f"{_CYAN}{s}{_END}"
 
-    def green(s):
-        return COLORS.GREEN + str(s) + COLORS.END
 
-    def red(s):
-        return COLORS.RED + str(s) + COLORS.END
+def red(s):
+    return f"{_RED}{s}{_END}"
 
-    def bold(s):
-        return COLORS.BOLD + str(s) + COLORS.END
 
+def bold(s):
+    return f"{_BOLD}{s}{_END}"
 
+
+# Don't write escape sequences when the output isn't a terminal
+if not sys.stdout.isatty():
+    cyan = red = bold = str
+
+
+@functools.lru_cache(maxsize=1)
 def parse_os_release():
-    line_re = re.compile('^([A-Z_]*)="?(.*?)"?$')
-    os_release_path = Path("/etc/os-release")
+    try:
+        fd = os.open("/etc/os-release", os.O_RDONLY)
+    except FileNotFoundError:
+        return {}
+    try:
+        content = os.read(fd, 65536).decode()
+    finally:
+        os.close(fd)
+
     os_release_dict = {}
-    if os_release_path.is_file():
-        content = os_release_path.read_text()
-        for line in content.split("\n"):
-            match = line_re.match(line)
-            if match:
-                os_release_dict[match.group(1)] = match.group(2)
+    for line in content.splitlines():
+        key, sep, value = line.partition("=")
+        if not sep or not key.isidentifier():
+            continue
+        os_release_dict[key] = value.strip().strip('"')
     return os_release_dict
 
 
@@ -53,108 +66,282 @@ def get_os_version_id():
         return None
 
 
+_CODENAMES = {
+    ("debian", "9"): "stretch",
+    ("debian", "10"): "buster",
+    ("debian", "11"): "bullseye",
+    ("debian", "12"): "bookworm",
+    ("ubuntu", "20.04"): "focal",
+}
+_DISTRO_NAMES = {"debian": "Debian", "ubuntu": "Ubuntu"}
+
+
 def get_codename():
-    if get_os_id() == "debian":
-        os_version_id = get_os_version_id()
-        if os_version_id is None:
-            os_version_id = "12"  # force testing
-        if os_version_id == "9":
-            return "stretch"
-        elif os_version_id == "10":
-            return "buster"
-        elif os_version_id == "11":
-            return "bullseye"
-        elif os_version_id == "12":
-            return "bookworm"
-        else:
-            raise RuntimeError(
-                COLORS.bold(COLORS.red("Unable to find Debian distro codename"))
-            )
-    elif get_os_id() == "ubuntu":
-        if os_version_id == "20.04":
-            return "focal"
-        else:
-            raise RuntimeError(
-                COLORS.bold(COLORS.red("Unable to find Ubuntu distro codename"))
-            )
+    os_release = parse_os_release()
+    os_id = os_release.get("ID")
+    # testing doesn't provides its version ID
+    os_version_id = os_release.get("VERSION_ID")
+    if os_id == "debian" and os_version_id is None:
+        os_version_id = "12"  # force testing
+
+    codename = _CODENAMES.get((os_id, os_version_id))
+    if codename is not None:
+        return codename
+    elif os_id in _DISTRO_NAMES:
+        raise RuntimeError(
+            bold(red("Unable to find %s distro codename" % _DISTRO_NAMES[os_id]))
+        )
     else:
-        raise RuntimeError(COLORS.bold(COLORS.red("Unable to find Linux distribution")))
+        raise RuntimeError(bold(red("Unable to find Linux distribution")))
+
+
+# A line holding an optional package name, with an optional architecture,
+# version or release, and an optional comment. Any other line is matched by the
+# second alternative, as an invalid line.
+_PKG_RE = re.compile(
+    rb"(?m)^[ \t]*(?:([A-Za-z0-9][A-Za-z0-9+\-.:=~/]*)[ \t]*)?(?:#.*)?\r?$|^(.+)$"
+)
+
+
+DependencyFiles = collections.namedtuple(
+    "DependencyFiles", ["prehooks", "pkglists", "backport_pkglists", "posthooks"]
+)
+DependencyPatterns = collections.namedtuple(
+    "DependencyPatterns", ["prehooks", "pkglists", "backport_pkglist", "posthooks"]
+)
+Dependencies = collections.namedtuple(
+    "Dependencies", ["prehooks", "packages", "backport_packages", "posthooks"]
+)
+
+
+def abort(message):
+    print(red(message), flush=True)
+    sys.exit(1)
+
+
+def walk_files(folder):
+    # os.scandir gets the entry types from the directory listing, so only
+    # symbolic links need a stat() to know whether they point to a file
+    folder_stack = [folder]
+    while folder_stack:
+        try:
+            it = os.scandir(folder_stack.pop())
+        except OSError:
+            # Skip unreadable folders, as glob does
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    folder_stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry.name, entry.path
+
+
+def get_dependency_patterns(codename):
+    return DependencyPatterns(
+        prehooks=("common.prepkg.", codename + ".prepkg."),
+        pkglists=("common.pkglist", codename + ".pkglist"),
+        backport_pkglist=codename + "-backports.pkglist",
+        posthooks=("common.postpkg.", codename + ".postpkg."),
+    )
+
+
+def common_first(path_list):
+    # Keep the common files before the codename specific ones
+    return sorted(
+        path_list, key=lambda path: not os.path.basename(path).startswith("common.")
+    )
+
+
+def get_folder_dependency_files(folder, patterns):
+    folder_files = DependencyFiles([], [], [], [])
+    for name, path in walk_files(folder):
+        if name in patterns.pkglists:
+            folder_files.pkglists.append(path)
+        elif name == patterns.backport_pkglist:
+            folder_files.backport_pkglists.append(path)
+        elif name.startswith(patterns.prehooks):
+            folder_files.prehooks.append(path)
+        elif name.startswith(patterns.posthooks):
+            folder_files.posthooks.append(path)
 
+    return DependencyFiles(*(common_first(files) for files in folder_files))
 
-def get_package_list(path_list, codename, backports=False):
-    if backports:
-        codename += "-backports"
-    # Get the list of package lists
-    lists_list = []
-    for p in path_list:
-        if not backports:
-            lists_list += list(p.glob("**/common.pkglist"))
-        lists_list += list(p.glob("**/" + codename + ".pkglist"))
 
+def get_package_list(lists_list):
     # Get the package list from the lists
     package_list = []
     for l in lists_list:
-        content = l.read_text()
-        package_list += [
-            package
-            for package in content.split("\n")
-            if package and not package.startswith("#")
-        ]
+        fd = os.open(l, os.O_RDONLY)
+        try:
+            content = os.read(fd, os.fstat(fd).st_size)
+        finally:
+            os.close(fd)
+
+        for match in _PKG_RE.finditer(content):
+            package, invalid_line = match.groups()
+            if invalid_line is not None:
+                abort(
+                    "Invalid package line %r in %s:%d"
+                    % (
+                        invalid_line.decode("utf-8", errors="replace").rstrip(),
+                        l,
+                        content.count(b"\n", 0, match.start()) + 1,
+                    )
+                )
+            if package:
+                package_list.append(package.decode("utf-8"))
 
     return package_list
 
 
-def get_prehook_list(path_list, codename):
-    # Get the list of hooks
-    hook_list = []
-    for p in path_list:
-        hook_list += list(p.resolve().glob("**/common.prepkg.*"))
-        hook_list += list(p.resolve().glob("**/" + codename + ".prepkg.*"))
+def get_folder_dependencies(folder, patterns):
+    folder_files = get_folder_dependency_files(folder, patterns)
+    return Dependencies(
+        folder_files.prehooks,
+        get_package_list(folder_files.pkglists),
+        get_package_list(folder_files.backport_pkglists),
+        folder_files.posthooks,
+    )
 
-    return hook_list
 
+def get_dependencies(path_list, codename):
+    # Walk the folders and read their package lists concurrently, then merge
+    # the results in the order the folders were given
+    patterns = get_dependency_patterns(codename)
+    # Resolve each folder only once, and don't walk the same folder twice
+    folder_list = list(dict.fromkeys(os.path.realpath(p) for p in path_list))
+    for folder in folder_list:
+        if not os.path.isdir(folder):
+            abort("Unable to find folder %s" % folder)
+    dependencies = Dependencies([], [], [], [])
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(8, len(folder_list))
+    ) as executor:
+        for folder_dependencies in executor.map(
+            lambda folder: get_folder_dependencies(folder, patterns), folder_list
+        ):
+            for items, new_items in zip(dependencies, folder_dependencies):
+                items += new_items
+
+    # Nested folders find the same hooks, which would otherwise run twice and
+    # race with themselves, and several lists may ask for the same package.
+    # Only keep the first occurrence of each.
+    return Dependencies(*(list(dict.fromkeys(items)) for items in dependencies))
+
+
+def print_permission_error(cmd):
+    print(
+        red(
+            "Permission denied while executing %s. " % cmd
+            + bold("Is the file executable?")
+        )
+    )
 
-def get_posthook_list(path_list, codename):
-    # Get the list of hooks
-    hook_list = []
-    for p in path_list:
-        hook_list += list(p.resolve().glob("**/common.postpkg.*"))
-        hook_list += list(p.resolve().glob("**/" + codename + ".postpkg.*"))
 
-    return hook_list
+def abort_on_subprocess_error(e):
+    sys.stdout.flush()
+    sys.stderr.flush()
 
+    print(red("Error in subprocess, aborting."))
+    print(bold("  cmd: ") + str(e.cmd))
+    print(bold("  return code: ") + str(e.returncode))
 
-def execute_subprocess(cmd, env=None):
-    try:
-        # TODO see how we could display progress, or give a way get progress
-        # through a given file, or anything...
-        subprocess.run(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True, env=env
-        )
-    except PermissionError as e:
-        print(
-            COLORS.red(
-                "Permission denied while executing %s. " % cmd
-                + COLORS.bold("Is the file executable?")
-            )
-        )
-    except subprocess.CalledProcessError as e:
-        sys.stdout.flush()
-        sys.stderr.flush()
+    if e.stdout:
+        print(bold("  stdout:"))
+        print("%s" % e.stdout.decode("utf-8", errors="replace"))
+
+    if e.stderr:
+        print(bold("  stderr:"))
+        print("%s" % e.stderr.decode("utf-8", errors="replace"))
+
+    sys.exit(1)
 
-        print(COLORS.red("Error in subprocess, aborting."))
-        print(COLORS.bold("  cmd: ") + str(e.cmd))
-        print(COLORS.bold("  return code: ") + str(e.returncode))
 
-        if e.stdout:
-            print(COLORS.bold("  stdout:"))
-            print("%s" % e.stdout.decode("utf-8", errors="replace"))
+def read_output(output_file):
+    output_file.seek(0)
+    return output_file.read()
 
-        if e.stderr:
-            print(COLORS.bold("  stderr:"))
-            print("%s" % e.stderr.decode("utf-8", errors="replace"))
 
-        sys.exit(1)
+def execute_subprocess(cmd, env=None):
+    # stdout is only shown on error, so leave it in an unlinked temporary file
+    # instead of draining it through a pipe
+    with tempfile.TemporaryFile() as stdout:
+        try:
+            # TODO see how we could display progress, or give a way get progress
+            # through a given file, or anything...
+            subprocess.run(
+                cmd, stdout=stdout, stderr=subprocess.PIPE, check=True, env=env
+            )
+        except PermissionError as e:
+            print_permission_error(cmd)
+        except subprocess.CalledProcessError as e:
+            e.stdout = read_output(stdout)
+            abort_on_subprocess_error(e)
+
+
+def execute_subprocesses(cmd_list):
+    # Run the commands concurrently, at most one per CPU at a time, and stop as
+    # soon as one of them fails. Their outputs go to temporary files, so none
+    # of them can block on a full pipe while another one is waited for.
+    max_running = os.cpu_count() or 1
+    pending = collections.deque(cmd_list)
+    running = {}
+    try:
+        while pending or running:
+            while pending and len(running) < max_running:
+                cmd = pending.popleft()
+                stdout = tempfile.TemporaryFile()
+                stderr = tempfile.TemporaryFile()
+                try:
+                    proc = subprocess.Popen(cmd, stdout=stdout, stderr=stderr)
+                except OSError as e:
+                    stdout.close()
+                    stderr.close()
+                    if isinstance(e, PermissionError):
+                        print_permission_error(cmd)
+                        continue
+                    abort("Unable to execute %s: %s" % (cmd, e.strerror))
+                running[proc.pid] = (proc, stdout, stderr)
+            if not running:
+                break
+
+            # Wait for whichever command exits first, leaving it to Popen to
+            # reap it so that its return code is recorded
+            pid = os.waitid(os.P_ALL, 0, os.WEXITED | os.WNOWAIT).si_pid
+            proc, stdout, stderr = running.pop(pid)
+            proc.wait()
+            if proc.returncode:
+                abort_on_subprocess_error(
+                    subprocess.CalledProcessError(
+                        proc.returncode,
+                        proc.args,
+                        read_output(stdout),
+                        read_output(stderr),
+                    )
+                )
+            stdout.close()
+            stderr.close()
+    finally:
+        # Don't leave anything running behind when aborting
+        for proc, stdout, stderr in running.values():
+            proc.kill()
+            proc.wait()
+            stdout.close()
+            stderr.close()
+
+
+def execute_hooks(hook_list):
+    # The common hooks may prepare what the codename specific ones need, so
+    # they are all done before the codename specific ones are started
+    common_hooks = [
+        hook for hook in hook_list if os.path.basename(hook).startswith("common.")
+    ]
+    codename_hooks = [
+        hook for hook in hook_list if not os.path.basename(hook).startswith("common.")
+    ]
+    for hooks in (common_hooks, codename_hooks):
+        execute_subprocesses([[hook] for hook in hooks])
 
 
 def main():
@@ -176,9 +363,12 @@ with the following patterns:
 
 The *.pkglist files should contain one package name per line, and they will be
 concatenated before calling the package manager. Comments are supported in the
-form of lines starting with '#'.
+form of lines starting with '#', or of '#' and anything after it following a
+package name.
 The *.prepkg.* and *.postpkg.* files should be executable, and will be executed
-before and after the call to the package manager, respectively.
+before and after the call to the package manager, respectively. Hooks of the
+same kind are run concurrently, the common ones before the codename specific
+ones, so hooks of the same group should not depend on each other.
 
 Example:
 
@@ -205,50 +395,86 @@ dependencies.
         nargs="+",
         help="A list of folder to search for dependencies list",
     )
+    parser.add_argument(
+        "--separate-backports-install",
+        action="store_true",
+        help="Install the backports packages with a separate apt call using "
+        "'-t <codename>-backports', instead of pinning them to the backports "
+        "release in the same apt call as the other packages",
+    )
 
     args = parser.parse_args()
 
     codename = get_codename()
-    print(COLORS.cyan("distro codename: ") + codename, flush=True)
+    print(cyan("distro codename: ") + codename, flush=True)
 
-    prehook_list = get_prehook_list(args.folder, codename)
-    package_list = get_package_list(args.folder, codename)
-    package_backport_list = get_package_list(args.folder, codename, backports=True)
-    posthook_list = get_posthook_list(args.folder, codename)
+    dependencies = get_dependencies(args.folder, codename)
+    prehook_list = dependencies.prehooks
+    package_list = dependencies.packages
+    package_backport_list = dependencies.backport_packages
+    posthook_list = dependencies.posthooks
 
     if prehook_list:
-        print(COLORS.cyan("running pre-packages hooks"), flush=True)
-        for hook in prehook_list:
-            execute_subprocess([str(hook)])
+        print(cyan("running pre-packages hooks"), flush=True)
+        execute_hooks(prehook_list)
 
     if package_list or package_backport_list:
-        print(COLORS.cyan("updating apt database"), flush=True)
+        print(cyan("updating apt database"), flush=True)
         execute_subprocess(["apt", "update"])
 
-    if package_list:
-        print(COLORS.cyan("installing packages: ") + str(package_list), flush=True)
-        env = os.environ.copy()
-        env["DEBIAN_FRONTEND"] = "noninteractive"
-        execute_subprocess(["apt", "install", "-y"] + package_list, env)
-
-    if package_backport_list:
-        print(
-            COLORS.cyan("installing packages from backports: ")
-            + str(package_backport_list),
-            flush=True,
-        )
-        env = os.environ.copy()
-        env["DEBIAN_FRONTEND"] = "noninteractive"
+    apt_env = {
+        **os.environ,
+        "DEBIAN_FRONTEND": "noninteractive",
+        "DEBCONF_NONINTERACTIVE_SEEN": "true",
+        "APT_LISTCHANGES_FRONTEND": "none",
+    }
+
+    if package_backport_list and not args.separate_backports_install:
+        # Install everything in a single apt transaction, selecting the
+        # backports release for the backports packages only
+        if package_list:
+            print(
+                cyan("installing packages: ")
+                + str(package_list)
+                + cyan(" and from backports: ")
+                + str(package_backport_list),
+                flush=True,
+            )
+        else:
+            print(
+                cyan("installing packages from backports: ")
+                + str(package_backport_list),
+                flush=True,
+            )
         execute_subprocess(
-            ["apt", "install", "-t", codename + "-backports", "-y"]
-            + package_backport_list,
-            env,
+            ["apt", "install", "-y"]
+            + package_list
+            + [
+                package + "/" + codename + "-backports"
+                for package in package_backport_list
+            ],
+            apt_env,
         )
+    else:
+        if package_list:
+            print(cyan("installing packages: ") + str(package_list), flush=True)
+            execute_subprocess(["apt", "install", "-y"] + package_list, apt_env)
+
+        if package_backport_list:
+            print(
+                cyan("installing packages from backports: ")
+                + str(package_backport_list),
+                flush=True,
+            )
+            execute_subprocess(
+                ["apt", "install", "-t", codename + "-backports", "-y"]
+                + package_backport_list,
+                apt_env,
+            )
 
     if posthook_list:
-        print(COLORS.cyan("running post-packages hooks"), flush=True)
-        for hook in posthook_list:
-            execute_subprocess([str(hook)])
+        print(cyan("running post-packages hooks"), flush=True)
+        execute_hooks(posthook_list)
 
 
 if __name__ == "__main__":